@@ -1,11 +1,19 @@
+import os
 import time
+import random
 import asyncio
 import aiohttp
-import pandas as pd
+import orjson
+from yarl import URL
+from multidict import CIMultiDict
 from sys import stderr
+from openpyxl import load_workbook
 from loguru import logger
 from eth_account.account import Account
-from eth_account.messages import encode_typed_data, encode_defunct
+from eth_account.signers.local import LocalAccount
+from eth_account.messages import encode_defunct
+from eth_abi import encode
+from eth_utils import keccak
 
 logger.remove()
 logger.add(stderr,
@@ -13,245 +21,312 @@ logger.add(stderr,
                   "| <lw>{message}</lw>")
 
 
-def async_error_handler(error_msg, retries=3):
+def _read_concurrency(default: int = 20) -> int:
+    value = os.getenv('CONCURRENCY') or str(default)
+    try:
+        concurrency = int(value)
+    except ValueError:
+        raise SystemExit(f'CONCURRENCY must be an integer, got {value!r}')
+
+    if concurrency < 1:
+        logger.warning(f'CONCURRENCY={concurrency} is less than 1, using 1')
+    return max(1, concurrency)
+
+
+CONCURRENCY: int = _read_concurrency()  # колличество потоков
+ACCOUNT_TIMEOUT: int = 180  # максимальное время на один аккаунт, сек
+
+_MERKLE_ROOT = '0xbc6264e25255e1b3d456ec287615879c2525828345a3d4d4c09eb11baa2d201f'
+
+_VERIFYING_CHAIN_ID = 1729
+_VERIFYING_CONTRACT = '0x14d7c1efc024e118df70b241afbd2447d37f1ed6'
+_TO_ADDR = '0xa763b6a5e09378434406c003dae6487fbbdc1a80'
+_SELECTOR = '0x9859387b' + '00' * 12  # createAccount(address), адрес дописывается без 0x
+
+# EIP-712 domain и type hashes одинаковые для всех аккаунтов - считаем один раз при импорте
+_DOMAIN_SEPARATOR: bytes = keccak(encode(
+    ['bytes32', 'bytes32', 'bytes32', 'address'],
+    [
+        keccak(b'EIP712Domain(string name,string version,address verifyingContract)'),
+        keccak(b'Reya'),
+        keccak(b'1'),
+        _VERIFYING_CONTRACT,
+    ],
+))
+_LEAF_TYPEHASH: bytes = keccak(b'LeafInfo(address owner,uint256 tokenRootCount)')
+_MINT_TYPEHASH: bytes = keccak(b'MintBySig(uint256 verifyingChainId,address owner,LeafInfo leafInfo,bytes32 merkleRoot,'
+                               b'uint256 deadline)LeafInfo(address owner,uint256 tokenRootCount)')
+_MERKLE_ROOT_BYTES: bytes = bytes.fromhex(_MERKLE_ROOT[2:])
+
+_HEADERS = CIMultiDict({
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
+    'Connection': 'keep-alive',
+    'Origin': 'https://app.reya.network',
+    'Referer': 'https://app.reya.network/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'cross-site',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/126.0.0.0 Safari/537.36',
+    'sec-ch-ua': '"Not/A)Brand";v="8", "Chromium";v="126", "Google Chrome";v="126"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+})
+
+_TOS_TEXT = ('Reya Labs Limited Terms and Conditions: '
+             'https://reya.xyz/files/ReyaLabsLimited_Reya_xyz_T&Cs_04April2024.pdf')
+_TOS_MESSAGE = encode_defunct(text=_TOS_TEXT)
+
+
+def async_error_handler(error_msg, retries=3, retry_on=(aiohttp.ClientError, asyncio.TimeoutError)):
     def decorator(func):
         async def wrapper(*args, **kwargs):
             for i in range(0, retries):
                 try:
                     return await func(*args, **kwargs)
-                except Exception as e:
-                    # logger.error(f"{error_msg}: {str(e)}")
+                except retry_on as e:
+                    logger.debug(f"{error_msg} (attempt {i + 1}/{retries}): {str(e)}")
                     if i == retries - 1:
-                        return 0
-                    await asyncio.sleep(2)
+                        # ошибку не теряем - start_work залогирует её как Failed
+                        raise RuntimeError(f"{error_msg} failed after {retries} attempts: {type(e).__name__}: {str(e)}") from e
+                    await asyncio.sleep(min(30, (2 ** i) + random.random()))
 
         return wrapper
 
     return decorator
 
 
+async def read_json(response: aiohttp.ClientResponse) -> dict | list:
+    # HTML-страница от прокси/Cloudflare или пустое тело - ошибка сети, её должен повторить async_error_handler
+    try:
+        data = await response.json(loads=orjson.loads, content_type=None)
+    except ValueError as e:
+        raise aiohttp.ClientPayloadError(f'invalid JSON from {response.url}: {str(e)}') from e
+
+    if data is None:
+        raise aiohttp.ClientPayloadError(f'empty response body from {response.url}')
+    return data
+
+
 class ReyaOGClaimer:
-    def __init__(self, private_key: str, proxy: str, number_acc: int) -> None:
-        self.private_key = private_key
-        self.account = Account().from_key(private_key=private_key)
-        self.proxy: str = f"http://{proxy}" if proxy is not None else None
+    def __init__(self, private_key: str, proxy: str | None, number_acc: int, session: aiohttp.ClientSession,
+                 deadline: int) -> None:
+        self.account: LocalAccount = Account.from_key(private_key=private_key)
+        self._addr: str = self.account.address
+        self.proxy: URL | None = URL(f"http://{proxy}") if proxy is not None else None
         self.id: int = number_acc
-        self.client = None
+        self.client: aiohttp.ClientSession = session
+        self.deadline: int = deadline
 
     async def create_message(self) -> str and int:
-        deadline: int = int(time.time() + 600000)
-
-        message = {
-            "types": {
-                "MintBySig": [
-                    {
-                        "name": "verifyingChainId",
-                        "type": "uint256"
-                    },
-                    {
-                        "name": "owner",
-                        "type": "address"
-                    },
-                    {
-                        "name": "leafInfo",
-                        "type": "LeafInfo"
-                    },
-                    {
-                        "name": "merkleRoot",
-                        "type": "bytes32"
-                    },
-                    {
-                        "name": "deadline",
-                        "type": "uint256"
-                    }
-                ],
-                "LeafInfo": [
-                    {
-                        "name": "owner",
-                        "type": "address"
-                    },
-                    {
-                        "name": "tokenRootCount",
-                        "type": "uint256"
-                    }
-                ],
-                "EIP712Domain": [
-                    {
-                        "name": "name",
-                        "type": "string"
-                    },
-                    {
-                        "name": "version",
-                        "type": "string"
-                    },
-                    {
-                        "name": "verifyingContract",
-                        "type": "address"
-                    }
-                ]
-            },
-            "domain": {
-                "name": "Reya",
-                "version": "1",
-                "verifyingContract": "0x14d7c1efc024e118df70b241afbd2447d37f1ed6"
-            },
-            "primaryType": "MintBySig",
-            "message": {
-                "verifyingChainId": "1729",
-                "owner": self.account.address,
-                "leafInfo": {
-                    "owner": self.account.address,
-                    "tokenRootCount": "0"
-                },
-                "merkleRoot": "0xbc6264e25255e1b3d456ec287615879c2525828345a3d4d4c09eb11baa2d201f",
-                "deadline": deadline
-            }
-        }
+        deadline: int = self.deadline
 
-        signature = Account.sign_message(encode_typed_data(full_message=message), self.private_key).signature.hex()
+        leaf_hash: bytes = keccak(encode(['bytes32', 'address', 'uint256'], [_LEAF_TYPEHASH, self._addr, 0]))
+        struct_hash: bytes = keccak(encode(
+            ['bytes32', 'uint256', 'address', 'bytes32', 'bytes32', 'uint256'],
+            [_MINT_TYPEHASH, _VERIFYING_CHAIN_ID, self._addr, leaf_hash, _MERKLE_ROOT_BYTES, deadline],
+        ))
+        digest: bytes = keccak(b'\x19\x01' + _DOMAIN_SEPARATOR + struct_hash)
+
+        signature = self.account.unsafe_sign_hash(digest).signature.hex()
         return signature, deadline
 
+    async def add_tos_signature(self) -> None:
+        text_signature = self.account.sign_message(_TOS_MESSAGE)
+
+        async with self.client.post(
+            f'https://api.reya.xyz/api/owner/tos/add-signature',
+            json={
+                'signature': f'0x{text_signature.signature.hex()}',
+                'walletAddress': self._addr,
+                'message': _TOS_TEXT,
+                'version': '4',
+            },
+            proxy=self.proxy,
+        ) as response:
+            await response.release()
+
+    async def create_margin_account(self) -> bytes:
+        async with self.client.post(
+            f'https://api.reya.xyz/api/transaction-gelato/executeGelato',
+            json={
+                'txData': {
+                    'to': _TO_ADDR,
+                    'data': f'{_SELECTOR}{self._addr[2:]}',
+                },
+                'contractAddress': _TO_ADDR,
+                'metadata': {
+                    'accountName': 'Margin Account 1',
+                    'action': 'createAccount',
+                    'sender': self._addr,
+                },
+            },
+            proxy=self.proxy,
+        ) as response:
+            return await response.read()
+
     async def activate_account(self):
-        response: aiohttp.ClientResponse = await self.client.get(
-            f'https://api.reya.xyz/api/accounts/{self.account.address}',
+        async with self.client.get(
+            f'https://api.reya.xyz/api/accounts/{self._addr}',
             proxy=self.proxy,
-        )
-        response_json: dict = await response.json()
+            raise_for_status=True,
+        ) as response:
+            response_json: dict = await read_json(response)
 
         if len(response_json) == 0:
-            logger.info(f'#{self.id} | {self.account.address} account is not activated')
-
-            msg = encode_defunct(text=f'Reya Labs Limited Terms and Conditions: '
-                                      f'https://reya.xyz/files/ReyaLabsLimited_Reya_xyz_T&Cs_04April2024.pdf')
-            text_signature = self.account.sign_message(msg)
+            logger.info(f'#{self.id} | {self._addr} account is not activated')
 
-            response: aiohttp.ClientResponse = await self.client.post(
-                f'https://api.reya.xyz/api/owner/tos/add-signature',
-                json={
-                    'signature': f'0x{text_signature.signature.hex()}',
-                    'walletAddress': self.account.address,
-                    'message': 'Reya Labs Limited Terms and Conditions: '
-                               'https://reya.xyz/files/ReyaLabsLimited_Reya_xyz_T&Cs_04April2024.pdf',
-                    'version': '4',
-                },
-                proxy=self.proxy,
-            )
+            await ReyaOGClaimer.add_tos_signature(self)
+            body: bytes = await ReyaOGClaimer.create_margin_account(self)
 
-            response: aiohttp.ClientResponse = await self.client.post(
-                f'https://api.reya.xyz/api/transaction-gelato/executeGelato',
-                json={
-                    'txData': {
-                        'to': '0xa763b6a5e09378434406c003dae6487fbbdc1a80',
-                        'data': f'0x9859387b000000000000000000000000{self.account.address[2:]}',
-                    },
-                    'contractAddress': '0xa763b6a5e09378434406c003dae6487fbbdc1a80',
-                    'metadata': {
-                        'accountName': 'Margin Account 1',
-                        'action': 'createAccount',
-                        'sender': self.account.address,
-                    },
-                },
-                proxy=self.proxy,
-            )
-            response_json: dict = await response.json()
+            if b'"txHash"' in body:
+                logger.success(f'#{self.id} | {self._addr} account activated')
 
-            if 'txHash' in response_json:
-                logger.success(f'#{self.id} | {self.account.address} account activated')
+    async def get_mint_status(self) -> dict:
+        async with self.client.get(
+            f'https://api.reya.xyz/api/sbt/mint-status/owner/{self._addr}/tokenCount/0',
+            proxy=self.proxy,
+            raise_for_status=True,
+        ) as response:
+            return await read_json(response)
 
     @async_error_handler('check_eligible')
     async def check_eligible(self) -> None:
-        async with aiohttp.ClientSession(headers={
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
-            'Connection': 'keep-alive',
-            'Origin': 'https://app.reya.network',
-            'Referer': 'https://app.reya.network/',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'cross-site',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/126.0.0.0 Safari/537.36',
-            'sec-ch-ua': '"Not/A)Brand";v="8", "Chromium";v="126", "Google Chrome";v="126"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-        }) as client:
-            self.client = client
-
-            await ReyaOGClaimer.activate_account(self)
-
-            response: aiohttp.ClientResponse = await self.client.get(
-                f'https://api.reya.xyz/api/sbt/mint-status/owner/{self.account.address}/tokenCount/0',
+        # статус минта не зависит от активации аккаунта - запрашиваем параллельно
+        activation = asyncio.create_task(ReyaOGClaimer.activate_account(self))
+        mint_status = asyncio.create_task(ReyaOGClaimer.get_mint_status(self))
+        try:
+            await asyncio.gather(activation, mint_status)
+        except asyncio.CancelledError:
+            # внешний таймаут/отмена - останавливаем оба запроса
+            activation.cancel()
+            mint_status.cancel()
+            raise
+        except Exception:
+            if activation.done():
+                # упала активация - GET статуса можно спокойно оборвать
+                mint_status.cancel()
+                await asyncio.gather(mint_status, return_exceptions=True)
+            else:
+                # упал только статус - даём активации дойти до конца, иначе POST-ы уйдут повторно при ретрае
+                await asyncio.gather(activation, return_exceptions=True)
+            raise
+        response_json: dict = mint_status.result()
+        if response_json['isEligible'] and not response_json['hasMinted']:
+            logger.info(f'#{self.id} | {self._addr} eligible')
+
+            signature, deadline = await ReyaOGClaimer.create_message(self)
+
+            async with self.client.put(
+                f'https://api.reya.xyz/api/sbt/mint',
+                json={
+                    'owner': self._addr,
+                    'merkleRoot': _MERKLE_ROOT,
+                    'tokenRootCounter': 0,
+                    'signature': f'0x{signature}',
+                    'signatureDeadline': deadline,
+                },
                 proxy=self.proxy,
-            )
-            response_json: dict = await response.json()
-            if response_json['isEligible'] and not response_json['hasMinted']:
-                logger.info(f'#{self.id} | {self.account.address} eligible')
+            ) as response:
+                body: bytes = await response.read()
 
-                signature, deadline = await ReyaOGClaimer.create_message(self)
+            if b'"txHash"' in body:
+                logger.success(f'#{self.id} | {self._addr} success minted')
 
-                response: aiohttp.ClientResponse = await self.client.put(
-                    f'https://api.reya.xyz/api/sbt/mint',
-                    json={
-                        'owner': self.account.address,
-                        'merkleRoot': '0xbc6264e25255e1b3d456ec287615879c2525828345a3d4d4c09eb11baa2d201f',
-                        'tokenRootCounter': 0,
-                        'signature': f'0x{signature}',
-                        'signatureDeadline': deadline,
-                    },
-                    proxy=self.proxy,
-                )
-                response_json: dict = await response.json()
+            else:
+                logger.info(f'#{self.id} | {self._addr} not minted')
 
-                if 'txHash' in response_json:
-                    logger.success(f'#{self.id} | {self.account.address} success minted')
+        elif response_json['isEligible'] and response_json['hasMinted']:
+            logger.info(f'#{self.id} | {self._addr} already minted')
 
-                else:
-                    logger.info(f'#{self.id} | {self.account.address} not minted')
+        elif not response_json['isEligible']:
+            logger.info(f'#{self.id} | {self._addr} not eligible')
 
-            elif response_json['isEligible'] and response_json['hasMinted']:
-                logger.info(f'#{self.id} | {self.account.address} already minted')
 
-            elif not response_json['isEligible']:
-                logger.info(f'#{self.id} | {self.account.address} not eligible')
+async def start_work(account: list, id_acc: int, session: aiohttp.ClientSession, deadline: int) -> None:
+    acc = ReyaOGClaimer(private_key=account[0], proxy=account[1],
+                        number_acc=id_acc, session=session, deadline=deadline)
 
+    try:
 
-async def start_work(account: list, id_acc: int, semaphore) -> None:
-    async with semaphore:
-        acc = ReyaOGClaimer(private_key=account[0], proxy=account[1],
-                            number_acc=id_acc)
+        await asyncio.wait_for(acc.check_eligible(), timeout=ACCOUNT_TIMEOUT)
 
-        try:
+    except asyncio.TimeoutError:
+        logger.error(f'ID account:{id_acc} Failed: timed out after {ACCOUNT_TIMEOUT}s')
+
+    except Exception as e:
+        logger.error(f'ID account:{id_acc} Failed: {str(e)}')
 
-            await acc.check_eligible()
 
-        except Exception as e:
-            logger.error(f'ID account:{id_acc} Failed: {str(e)}')
+async def worker(queue: asyncio.Queue, session: aiohttp.ClientSession, deadline: int) -> None:
+    while True:
+        id_acc, account = await queue.get()
+        try:
+            await start_work(account=account, id_acc=id_acc, session=session, deadline=deadline)
+        finally:
+            queue.task_done()
+
+
+def load_accounts(path: str) -> list[list]:
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        # как pd.read_excel: первый лист, колонки ищем по заголовку, а не по позиции
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header: list = list(next(rows, ()))
+        if 'Private key' not in header:
+            raise SystemExit(f'{path}: column "Private key" not found in the header row')
+        key_idx: int = header.index('Private key')
+        proxy_idx: int | None = header.index('Proxy') if 'Proxy' in header else None
+
+        accounts: list[list] = []
+        for row in rows:
+            private_key = row[key_idx] if key_idx < len(row) else None
+            proxy = row[proxy_idx] if proxy_idx is not None and proxy_idx < len(row) else None
+            if private_key is not None:
+                accounts.append([private_key, proxy if isinstance(proxy, str) else None])
+        return accounts
+    finally:
+        wb.close()
 
 
 async def main() -> None:
-    semaphore: asyncio.Semaphore = asyncio.Semaphore(1)  # колличество потоков
+    # дедлайн подписи ~7 дней, один на весь прогон
+    deadline: int = int(time.time()) + 600000
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for idx, account in enumerate(accounts, start=1):
+        queue.put_nowait((idx, account))
+
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY * 2, limit_per_host=CONCURRENCY * 2, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=30, connect=10, sock_read=15)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=_HEADERS,
+                                     json_serialize=lambda obj: orjson.dumps(obj).decode()) as session:
+        workers: list[asyncio.Task] = [
+            asyncio.create_task(coro=worker(queue=queue, session=session, deadline=deadline))
+            for _ in range(min(CONCURRENCY, len(accounts)))
+        ]
+        await queue.join()
 
-    tasks: list[asyncio.Task] = [
-        asyncio.create_task(coro=start_work(account=account, id_acc=idx, semaphore=semaphore))
-        for idx, account in enumerate(accounts, start=1)
-    ]
-    await asyncio.gather(*tasks)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 
 if __name__ == '__main__':
-    with open('accounts_data.xlsx', 'rb') as file:
-        exel = pd.read_excel(file)
-    accounts: list[list] = [
-        [
-            row["Private key"],
-            row["Proxy"] if isinstance(row["Proxy"], str) else None
-        ]
-        for index, row in exel.iterrows()
-    ]
+    try:
+        import uvloop  # на Windows uvloop нет - остаётся стандартный event loop
+    except ImportError:
+        uvloop = None
+
+    accounts: list[list] = load_accounts('accounts_data.xlsx')
     logger.info(f'My channel: https://t.me/CryptoMindYep')
     logger.info(f'Total wallets: {len(accounts)}\n')
 
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
 
     logger.success('The work completed')
     logger.info('Thx for donat: 0x5AfFeb5fcD283816ab4e926F380F9D0CBBA04d0e')